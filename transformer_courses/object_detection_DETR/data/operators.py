@@ -14,6 +14,7 @@ from paddle.io import DistributedBatchSampler
 from paddle.fluid.dataloader.collate import default_collate_fn
 
 from utils import bbox_utils
+from utils.util import polys_to_masks
 
 SIZE_UNIT = ['K', 'M', 'G', 'T']
 def _parse_size_in_M(size_str):
@@ -22,6 +23,14 @@ def _parse_size_in_M(size_str):
             "unknown shm size unit {}".format(unit)
     return float(num) * \
             (1024 ** (SIZE_UNIT.index(unit) - 1))
+
+
+def is_poly(segm):
+    assert isinstance(segm, (list, dict)), \
+        "Invalid segm type: {}".format(type(segm))
+    return isinstance(segm, list)
+
+
 class Compose(object):
     def __init__(self, transforms, num_classes=80):
         self.transforms = transforms
@@ -629,7 +638,7 @@ class RandomSizeCrop(BaseOperator):
             sample['gt_poly'] = self.apply_segm(sample['gt_poly'], region,
                                                 image_shape)
             if keep_index is not None:
-                sample['gt_poly'] = sample['gt_poly'][keep_index]
+                sample['gt_poly'] = [sample['gt_poly'][i] for i in keep_index]
         # apply gt_segm
         if 'gt_segm' in sample and len(sample['gt_segm']) > 0:
             i, j, h, w = region
@@ -665,7 +674,7 @@ class RandomSizeCrop(BaseOperator):
                     polygon = MultiPolygon(polygons)
                 multi_polygon = list()
                 if isinstance(polygon, MultiPolygon):
-                    multi_polygon = copy.deepcopy(polygon)
+                    multi_polygon = copy.deepcopy(list(polygon.geoms))
                 else:
                     multi_polygon.append(copy.deepcopy(polygon))
                 for per_polygon in multi_polygon:
@@ -673,7 +682,7 @@ class RandomSizeCrop(BaseOperator):
                     if not inter:
                         continue
                     if isinstance(inter, (MultiPolygon, GeometryCollection)):
-                        for part in inter:
+                        for part in inter.geoms:
                             if not isinstance(part, Polygon):
                                 continue
                             part = np.squeeze(
@@ -795,6 +804,26 @@ class NormalizeBox(BaseOperator):
 
         return sample
 
+class Poly2Mask(BaseOperator):
+    """
+    Decode gt_poly into binary gt_segm masks of the current image size, so
+    the work runs in DataLoader workers instead of the training step.
+    The layout of the image should still be 'HWC', i.e. put this operator
+    after the geometric transforms and before Permute.
+    """
+
+    def __init__(self):
+        super(Poly2Mask, self).__init__()
+
+    def apply(self, sample, context=None):
+        assert 'gt_poly' in sample
+        im_h, im_w = sample['image'].shape[:2]
+        sample['gt_segm'] = polys_to_masks(sample['gt_poly'], im_h, im_w)
+        # the ragged polygon lists are not needed once decoded and cannot
+        # be collated into tensors
+        sample.pop('gt_poly')
+        return sample
+
 class BboxXYXY2XYWH(BaseOperator):
     """
     Convert bbox XYXY format to XYWH format.
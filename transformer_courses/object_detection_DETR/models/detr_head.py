@@ -1,27 +1,36 @@
-import pycocotools.mask as mask_util
+import numpy as np
+import paddle
 import paddle.nn as nn
 import paddle.nn.functional as F
 
 from . initializer import linear_init_
+from utils.util import polys_to_masks
 
 class MLP(nn.Layer):
     def __init__(self, input_dim, hidden_dim, output_dim, num_layers):
         super().__init__()
         self.num_layers = num_layers
         h = [hidden_dim] * (num_layers - 1)
-        self.layers = nn.LayerList(
-            nn.Linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim]))
+        linears = [
+            nn.Linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim])
+        ]
+        self._reset_parameters(linears)
 
-        self._reset_parameters()
-        
-    def _reset_parameters(self):
-        for l in self.layers:
+        # linears keep the names '0', '1', ... so parameter keys match the
+        # former LayerList; ReLU is interleaved between them
+        named_layers = []
+        for i, layer in enumerate(linears):
+            if i > 0:
+                named_layers.append(('relu{}'.format(i - 1), nn.ReLU()))
+            named_layers.append((str(i), layer))
+        self.layers = nn.Sequential(*named_layers)
+
+    def _reset_parameters(self, linears):
+        for l in linears:
             linear_init_(l)
 
     def forward(self, x):
-        for i, layer in enumerate(self.layers):
-            x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
-        return x
+        return self.layers(x)
 
 
 class MultiHeadAttentionMap(nn.Layer):
@@ -49,23 +58,63 @@ class MultiHeadAttentionMap(nn.Layer):
 
         self.normalize_fact = float(hidden_dim / self.num_heads)**-0.5
 
+        # bind hot-path ops once to skip module attribute lookups per call
+        self._einsum = getattr(paddle, 'einsum', None)
+        self._matmul = paddle.matmul
+        self._softmax = F.softmax
+        self._softmax_mask_fuse = getattr(paddle.incubate,
+                                          'softmax_mask_fuse', None)
+
+    def _can_fuse_mask(self, weights, n, hw):
+        # preconditions of the softmax_mask_fuse GPU kernel: key length in
+        # [32, 8192), query length (n here) > 1 and divisible by its rows per
+        # block, which is 8 for key lengths up to 128 and 4 above
+        if self._softmax_mask_fuse is None or not 32 <= hw < 8192:
+            return False
+        rows_per_block = 8 if hw <= 128 else 4
+        return n > 1 and n % rows_per_block == 0 and \
+            weights.dtype in (paddle.float16, paddle.float32) and \
+            weights.place.is_gpu_place()
+
+    def _masked_softmax(self, weights, mask=None):
+        # weights: [bs, num_queries, n, h*w], mask: [bs, 1, 1, h*w]
+        bs, _, n, hw = weights.shape
+        if mask is not None and self._can_fuse_mask(weights, n, hw):
+            # the fused GPU kernel adds the mask inside the softmax pass and
+            # takes one mask row per head: [bs, 1, n, h*w]
+            return self._softmax_mask_fuse(weights,
+                                           mask.expand([bs, 1, n, hw]))
+        if mask is not None:
+            weights = weights + mask
+        return self._softmax(weights, axis=-1)
+
     def forward(self, q, k, mask=None):
         q = self.q_proj(q)
         k = self.k_proj(k)
         bs, num_queries, n, c, h, w = q.shape[0], q.shape[1], self.num_heads,\
                                       self.hidden_dim // self.num_heads, k.shape[-2], k.shape[-1]
-        qh = q.reshape([bs, num_queries, n, c])
-        kh = k.reshape([bs, n, c, h, w])
-        # weights = paddle.einsum("bqnc,bnchw->bqnhw", qh * self.normalize_fact, kh)
-        qh = qh.transpose([0, 2, 1, 3]).reshape([-1, num_queries, c])
-        kh = kh.reshape([-1, c, h * w])
-        weights = paddle.bmm(qh * self.normalize_fact, kh).reshape(
-            [bs, n, num_queries, h, w]).transpose([0, 2, 1, 3, 4])
+        # q_proj/k_proj outputs are head-major along channels, so splitting
+        # heads is a view: q -> [bs, nq, n, c], k -> [bs, n, c, h, w]
+        # scale the queries, the smallest operand of the attention product
+        qh = q.reshape([bs, num_queries, n, c]) * self.normalize_fact
+        if self._einsum is not None:
+            weights = self._einsum("bqnc,bnchw->bqnhw", qh,
+                                   k.reshape([bs, n, c, h, w]))
+        else:
+            # paddle.einsum is only available since Paddle 2.3
+            weights = self._matmul(
+                qh.transpose([0, 2, 1, 3]), k.reshape([bs, n, c, h * w]))
+            weights = weights.reshape([bs, n, num_queries, h, w]).transpose(
+                [0, 2, 1, 3, 4])
 
         if mask is not None:
-            weights += mask
+            mask = mask.reshape([bs, 1, 1, h * w])
         # fix a potenial bug: https://github.com/facebookresearch/detr/issues/247
-        weights = F.softmax(weights.flatten(3), axis=-1).reshape(weights.shape)
+        # softmax jointly over (h, w); both reshapes are views of the
+        # contiguous einsum/transpose output, so no extra copy is made
+        weights = self._masked_softmax(
+            weights.reshape([bs, num_queries, n, h * w]),
+            mask).reshape([bs, num_queries, n, h, w])
         weights = self.dropout(weights)
         return weights
 
@@ -74,10 +123,29 @@ class MaskHeadFPNConv(nn.Layer):
     """
     Simple convolutional head, using group norm.
     Upsampling is done using a FPN approach
+
+    Args:
+        amp_dtype (str|None): if set ('float16' or 'bfloat16'), run the conv
+            stack under paddle.amp.auto_cast with this dtype while GroupNorm
+            stays in float32. 'float16' works with Paddle 2.1; 'bfloat16'
+            relies on auto_cast's dtype argument and needs Paddle >= 2.3.
     """
 
-    def __init__(self, input_dim, fpn_dims, context_dim, num_groups=8):
+    def __init__(self,
+                 input_dim,
+                 fpn_dims,
+                 context_dim,
+                 num_groups=8,
+                 amp_dtype=None):
         super().__init__()
+        assert amp_dtype in (None, 'float16', 'bfloat16'), \
+            "unsupported amp_dtype {}".format(amp_dtype)
+        self.amp_dtype = amp_dtype
+        # auto_cast only takes a dtype argument since Paddle 2.3 and defaults
+        # to float16, so pass it for bfloat16 only
+        self._amp_kwargs = {
+            'dtype': amp_dtype
+        } if amp_dtype == 'bfloat16' else {}
 
         inter_dims = [input_dim,
                       ] + [context_dim // (2**i) for i in range(1, 5)]
@@ -86,6 +154,7 @@ class MaskHeadFPNConv(nn.Layer):
         bias_attr = paddle.framework.ParamAttr(
             initializer=paddle.nn.initializer.Constant())
 
+        self.context_dim = context_dim
         self.conv0 = self._make_layers(input_dim, input_dim, 3, num_groups,
                                        weight_attr, bias_attr)
         self.conv_inter = nn.LayerList()
@@ -112,6 +181,8 @@ class MaskHeadFPNConv(nn.Layer):
                     weight_attr=weight_attr,
                     bias_attr=bias_attr))
 
+        self._interpolate = F.interpolate
+
     def _make_layers(self,
                      in_dims,
                      out_dims,
@@ -130,18 +201,47 @@ class MaskHeadFPNConv(nn.Layer):
             nn.GroupNorm(num_groups, out_dims),
             nn.ReLU())
 
+    def _add_per_image(self, x, feat, bs, num_q):
+        # x: [bs*num_q, C, H, W], feat: [bs, C, H, W] shared by all queries
+        x = x.reshape([bs, num_q] + x.shape[1:]) + feat.unsqueeze(1)
+        return x.flatten(0, 1)
+
     def forward(self, x, bbox_attention_map, fpns):
-        x = paddle.concat([
-            x.tile([bbox_attention_map.shape[1], 1, 1, 1]),
-            bbox_attention_map.flatten(0, 1)
-        ], 1)
-        x = self.conv0(x)
+        if self.amp_dtype is None:
+            return self._forward(x, bbox_attention_map, fpns)
+        # group_norm is black-listed so its statistics are computed in fp32
+        with paddle.amp.auto_cast(
+                custom_black_list={'group_norm'}, **self._amp_kwargs):
+            x = self._forward(x, bbox_attention_map, fpns)
+        return x.astype('float32')
+
+    def _forward(self, x, bbox_attention_map, fpns):
+        bs, num_q = bbox_attention_map.shape[0], bbox_attention_map.shape[1]
+        # conv0 acts on concat([x, bbox_attention_map]); split its weight by
+        # input channels so the x part runs once per image instead of once
+        # per query, and sum the two parts before the norm. Slicing copies
+        # the weight halves each call, which is small next to the tiled
+        # x input it replaces
+        conv, norm, act = self.conv0[0], self.conv0[1], self.conv0[2]
+        x = self._add_per_image(
+            F.conv2d(
+                bbox_attention_map.flatten(0, 1),
+                conv.weight[:, self.context_dim:],
+                padding=conv._padding),
+            F.conv2d(
+                x,
+                conv.weight[:, :self.context_dim],
+                conv.bias,
+                padding=conv._padding),
+            bs, num_q)
+        x = act(norm(x))
         for inter_layer, adapter_layer, feat in zip(self.conv_inter[:-1],
                                                     self.adapter, fpns):
-            feat = adapter_layer(feat).tile(
-                [bbox_attention_map.shape[1], 1, 1, 1])
+            feat = adapter_layer(feat)
+            feat_size = feat.shape[-2:]
             x = inter_layer(x)
-            x = feat + F.interpolate(x, size=feat.shape[-2:])
+            x = self._add_per_image(
+                self._interpolate(x, size=feat_size), feat, bs, num_q)
 
         x = self.conv_inter[-1](x)
         x = self.conv_out(x)
@@ -157,6 +257,7 @@ class DETRHead(nn.Layer):
                  loss='DETRLoss',
                  fpn_dims=[1024, 512, 256],
                  with_mask_head=False,
+                 mask_head_amp_dtype=None,
                  use_focal_loss=False):
         super(DETRHead, self).__init__()
         # add background class
@@ -174,8 +275,11 @@ class DETRHead(nn.Layer):
         if self.with_mask_head:
             self.bbox_attention = MultiHeadAttentionMap(hidden_dim, hidden_dim,
                                                         nhead)
-            self.mask_head = MaskHeadFPNConv(hidden_dim + nhead, fpn_dims,
-                                             hidden_dim)
+            self.mask_head = MaskHeadFPNConv(
+                hidden_dim + nhead,
+                fpn_dims,
+                hidden_dim,
+                amp_dtype=mask_head_amp_dtype)
         self._reset_parameters()
     def _reset_parameters(self):
         linear_init_(self.score_head)
@@ -183,19 +287,15 @@ class DETRHead(nn.Layer):
     @staticmethod
     def get_gt_mask_from_polygons(gt_poly, pad_mask):
         out_gt_mask = []
+        pad_h, pad_w = pad_mask.shape[1], pad_mask.shape[2]
         for polygons, padding in zip(gt_poly, pad_mask):
             height, width = int(padding[:, 0].sum()), int(padding[0, :].sum())
-            masks = []
-            for obj_poly in polygons:
-                rles = mask_util.frPyObjects(obj_poly, height, width)
-                rle = mask_util.merge(rles)
-                masks.append(
-                    paddle.to_tensor(mask_util.decode(rle)).astype('float32'))
-            masks = paddle.stack(masks)
-            masks_pad = paddle.zeros(
-                [masks.shape[0], pad_mask.shape[1], pad_mask.shape[2]])
+            # decode and pad on the host, then copy to device once per image
+            masks = polys_to_masks(polygons, height, width)
+            masks_pad = np.zeros(
+                [masks.shape[0], pad_h, pad_w], dtype='float32')
             masks_pad[:, :height, :width] = masks
-            out_gt_mask.append(masks_pad)
+            out_gt_mask.append(paddle.to_tensor(masks_pad))
         return out_gt_mask
 
     def forward(self, out_transformer, body_feats, inputs=None):
@@ -210,26 +310,33 @@ class DETRHead(nn.Layer):
             inputs (dict): dict(inputs)
         """
         feats, memory, src_proj, src_mask = out_transformer
-        outputs_logit = self.score_head(feats)
-        outputs_bbox = F.sigmoid(self.bbox_head(feats))
+        last_feat = feats[-1]
+        # the aux decoder levels only feed the training loss, so inference
+        # runs the heads on the last level alone
+        head_feats = feats if self.training else last_feat
+        outputs_logit = self.score_head(head_feats)
+        outputs_bbox = F.sigmoid(self.bbox_head(head_feats))
         outputs_seg = None
         if self.with_mask_head:
-            bbox_attention_map = self.bbox_attention(feats[-1], memory,
+            bs, num_queries = last_feat.shape[0], last_feat.shape[1]
+            bbox_attention_map = self.bbox_attention(last_feat, memory,
                                                      src_mask)
-            fpn_feats = [a for a in body_feats[::-1]][1:]
+            fpn_feats = body_feats[-2::-1]
             outputs_seg = self.mask_head(src_proj, bbox_attention_map,
                                          fpn_feats)
-            outputs_seg = outputs_seg.reshape([
-                feats.shape[1], feats.shape[2], outputs_seg.shape[-2],
-                outputs_seg.shape[-1]
-            ])
+            outputs_seg = outputs_seg.reshape([bs, num_queries] +
+                                              outputs_seg.shape[-2:])
 
         if self.training:
             assert inputs is not None
             assert 'gt_bbox' in inputs and 'gt_class' in inputs
-            gt_mask = self.get_gt_mask_from_polygons(
-                inputs['gt_poly'],
-                inputs['pad_mask']) if 'gt_poly' in inputs else None
+            gt_mask = None
+            if self.with_mask_head and 'gt_segm' in inputs:
+                # decoded and padded by Poly2Mask/PadMaskBatch in the loader
+                gt_mask = [m.astype('float32') for m in inputs['gt_segm']]
+            elif self.with_mask_head and 'gt_poly' in inputs:
+                gt_mask = self.get_gt_mask_from_polygons(inputs['gt_poly'],
+                                                         inputs['pad_mask'])
             return self.loss(
                 outputs_bbox,
                 outputs_logit,
@@ -238,4 +345,4 @@ class DETRHead(nn.Layer):
                 masks=outputs_seg,
                 gt_mask=gt_mask)
         else:
-            return (outputs_bbox[-1], outputs_logit[-1], outputs_seg)
\ No newline at end of file
+            return (outputs_bbox, outputs_logit, outputs_seg)
\ No newline at end of file
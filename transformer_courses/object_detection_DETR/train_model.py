@@ -92,8 +92,15 @@ def train(model, start_epoch, epoch,dataset_dir,image_dir,anno_path):
     _local_rank = dist.get_rank()
 
     # 读取训练集
-    dataset = COCODataSet(dataset_dir=dataset_dir, image_dir=image_dir,anno_path=anno_path,data_fields=['image', 'gt_bbox', 'gt_class', 'is_crowd'])
+    with_mask = model.detr_head.with_mask_head
+    data_fields = ['image', 'gt_bbox', 'gt_class', 'is_crowd']
+    if with_mask:
+        data_fields.append('gt_poly')
+    dataset = COCODataSet(dataset_dir=dataset_dir, image_dir=image_dir,anno_path=anno_path,data_fields=data_fields)
     sample_transforms = [{Decode: {}}, {RandomFlip: {'prob': 0.5}}, {RandomSelect: {'transforms1': [{RandomShortSideResize: {'short_side_sizes': [480, 512, 544, 576, 608, 640, 672, 704, 736, 768, 800], 'max_size': 1333}}], 'transforms2': [{RandomShortSideResize: {'short_side_sizes': [400, 500, 600]}}, {RandomSizeCrop: {'min_size': 384, 'max_size': 600}}, {RandomShortSideResize: {'short_side_sizes': [480, 512, 544, 576, 608, 640, 672, 704, 736, 768, 800], 'max_size': 1333}}]}}, {NormalizeImage: {'is_scale': True, 'mean': [0.485, 0.456, 0.406], 'std': [0.229, 0.224, 0.225]}}, {NormalizeBox: {}}, {BboxXYXY2XYWH: {}}, {Permute: {}}]
+    if with_mask:
+        # decode gt masks in the loader workers, before the image becomes CHW
+        sample_transforms.insert(-1, {Poly2Mask: {}})
     batch_transforms = [{PadMaskBatch: {'pad_to_stride': -1, 'return_pad_mask': True}}]    
     loader = BaseDataLoader(sample_transforms, batch_transforms, batch_size=2, shuffle=True, drop_last=True,collate_batch=False, use_shared_memory=False)(
         dataset, 0)
@@ -1,3 +1,5 @@
+import numpy as np
+import pycocotools.mask as mask_util
 import paddle
 import paddle.nn.functional as F
 
@@ -18,6 +20,39 @@ def sigmoid_focal_loss(logit, label, normalizer=1.0, alpha=0.25, gamma=2.0):
     return loss.mean(1).sum() / normalizer
 
 
+def polys_to_masks(polygons, height, width):
+    """
+    Decode per-object COCO polygons into binary masks.
+
+    Args:
+        polygons (list): one list of polygons per object.
+        height (int): mask height.
+        width (int): mask width.
+    Returns:
+        masks (np.ndarray): uint8 masks with shape [num_objects, height, width].
+    """
+    if len(polygons) == 0:
+        return np.zeros((0, height, width), dtype=np.uint8)
+    # frPyObjects picks its input type from the first entry only, so drop
+    # degenerate polygons (< 3 points) that would be read as boxes
+    polygons = [[poly for poly in obj_poly if len(poly) >= 6]
+                for obj_poly in polygons]
+    # convert all polygons with one frPyObjects call, then merge each
+    # object's slice of RLEs
+    flat_polys = [poly for obj_poly in polygons for poly in obj_poly]
+    rles = mask_util.frPyObjects(flat_polys, height,
+                                 width) if flat_polys else []
+    masks, start = [], 0
+    for obj_poly in polygons:
+        end = start + len(obj_poly)
+        if end > start:
+            masks.append(mask_util.decode(mask_util.merge(rles[start:end])))
+        else:
+            masks.append(np.zeros((height, width), dtype=np.uint8))
+        start = end
+    return np.stack(masks)
+
+
 # DETR调用
 def inverse_sigmoid(x, eps=1e-6):
     x = x.clip(min=0., max=1.)